@@ -769,6 +769,9 @@ class DNSQueryHandler:
         self._server = server
         self._client = client
 
+        # serialized request, reused until a retry action modifies the request
+        self._request_wire = None
+
         for handler in self._response_handlers:
             handler.set_context(self.params, self.history, self.request)
 
@@ -786,7 +789,9 @@ class DNSQueryHandler:
         self.params['wait'] = 0
 
     def get_query_transport_meta(self):
-        return transport.DNSQueryTransportMeta(self.request.to_wire(), self._server, self.params['tcp'], self.get_timeout(), \
+        if self._request_wire is None:
+            self._request_wire = self.request.to_wire()
+        return transport.DNSQueryTransportMeta(self._request_wire, self._server, self.params['tcp'], self.get_timeout(), \
                 self.query.odd_ports.get(self._server, self.query.port), src=self._client, sport=self.params['sport'])
 
     def get_remaining_lifetime(self):
@@ -818,6 +823,11 @@ class DNSQueryHandler:
                     handler.handle(response_wire, response, response_time)
 
             if retry_action is not None:
+                # all other actions modify the request, so it must be
+                # serialized anew
+                if retry_action.action not in (RETRY_ACTION_NO_CHANGE, RETRY_ACTION_USE_TCP, RETRY_ACTION_USE_UDP, RETRY_ACTION_CHANGE_SPORT):
+                    self._request_wire = None
+
                 # If we were unable to bind to the source address, then this is
                 # our fault
                 if retry_action.cause == RETRY_CAUSE_NETWORK_ERROR and retry_action.cause_arg == errno.EADDRNOTAVAIL:
@@ -1407,6 +1417,12 @@ class ExecutableDNSQuery(DNSQuery):
         if th_factories is None:
             th_factories = (cls.default_th_factory,)
 
+        # if specified, completion_callback is called with each query, as
+        # soon as all of its servers have been handled.  It returns a
+        # (possibly empty) list of new queries to be executed alongside those
+        # that are still outstanding.
+        completion_callback = kwargs.get('completion_callback', None)
+
         request_list = []
         response_queue = queue.Queue()
 
@@ -1414,41 +1430,47 @@ class ExecutableDNSQuery(DNSQuery):
         response_wire_map = {}
 
         query_handlers = {}
-        query_time = None
-        for th_factory in th_factories:
-            if not th_factory.cls.singleton:
-                th = th_factory.build(processed_queue=response_queue)
-
-            for query in queries:
-                qtm_for_server = False
-                for server in query.servers:
-                    if not th_factory.cls.allow_loopback_query and (LOOPBACK_IPV4_RE.match(server) or server == LOOPBACK_IPV6):
-                        continue
-                    if not th_factory.cls.allow_private_query and (RFC_1918_RE.match(server) or LINK_LOCAL_RE.match(server) or UNIQ_LOCAL_RE.match(server)):
-                        continue
-
-                    qtm_for_server = True
-                    qh = query.get_query_handler(server)
-                    qtm = qh.get_query_transport_meta()
-                    query_handlers[qtm] = qh
+        outstanding = {}
 
-                    if th_factory.cls.singleton:
-                        th = th_factory.build(processed_queue=response_queue)
-                        th.add_qtm(qtm)
-                        th.init_req()
-                        bisect.insort(request_list, (qh.query_time, th))
-                    else:
-                        # find the maximum query time
-                        if query_time is None or qh.query_time > query_time:
-                            query_time = qh.query_time
-                        th.add_qtm(qtm)
+        def _init_queries(queries):
+            query_time = None
+            for th_factory in th_factories:
+                if not th_factory.cls.singleton:
+                    th = th_factory.build(processed_queue=response_queue)
+
+                for query in queries:
+                    qtm_for_server = False
+                    for server in query.servers:
+                        if not th_factory.cls.allow_loopback_query and (LOOPBACK_IPV4_RE.match(server) or server == LOOPBACK_IPV6):
+                            continue
+                        if not th_factory.cls.allow_private_query and (RFC_1918_RE.match(server) or LINK_LOCAL_RE.match(server) or UNIQ_LOCAL_RE.match(server)):
+                            continue
+
+                        qtm_for_server = True
+                        qh = query.get_query_handler(server)
+                        qtm = qh.get_query_transport_meta()
+                        query_handlers[qtm] = qh
+                        outstanding[query] = outstanding.get(query, 0) + 1
+
+                        if th_factory.cls.singleton:
+                            th = th_factory.build(processed_queue=response_queue)
+                            th.add_qtm(qtm)
+                            th.init_req()
+                            bisect.insort(request_list, (qh.query_time, th))
+                        else:
+                            # find the maximum query time
+                            if query_time is None or qh.query_time > query_time:
+                                query_time = qh.query_time
+                            th.add_qtm(qtm)
+
+                    if not qtm_for_server:
+                        raise NoValidServersToQuery('No valid servers to query!')
 
-                if not qtm_for_server:
-                    raise NoValidServersToQuery('No valid servers to query!')
+                if not th_factory.cls.singleton:
+                    th.init_req()
+                    bisect.insort(request_list, (query_time, th))
 
-            if not th_factory.cls.singleton:
-                th.init_req()
-                bisect.insort(request_list, (query_time, th))
+        _init_queries(queries)
 
         while query_handlers:
             while request_list and time.time() >= request_list[0][0]:
@@ -1469,6 +1491,7 @@ class ExecutableDNSQuery(DNSQuery):
 
             newth = th.factory.build(processed_queue=response_queue)
             query_time = None
+            completed_queries = []
             for qtm in th.qtms:
                 # find its matching query meta information
                 qh = query_handlers.pop(qtm)
@@ -1573,10 +1596,21 @@ class ExecutableDNSQuery(DNSQuery):
                 # This query is now executed, at least in part
                 query._executed = True
 
+                outstanding[query] -= 1
+                if not outstanding[query]:
+                    del outstanding[query]
+                    if completion_callback is not None:
+                        completed_queries.append(query)
+
             if newth.qtms:
                 newth.init_req()
                 bisect.insort(request_list, (query_time, newth))
 
+            for query in completed_queries:
+                new_queries = completion_callback(query)
+                if new_queries:
+                    _init_queries(new_queries)
+
     def require_executed(func):
         def _func(self, *args, **kwargs):
             assert self._executed == True, "ExecutableDNSQuery has not been executed."
@@ -1598,6 +1632,15 @@ class ExecutableDNSQuery(DNSQuery):
     def execute(self, ignore_queryid=True, tm=None, th_factories=None):
         self.execute_queries(self, ignore_queryid=ignore_queryid, tm=tm, th_factories=th_factories)
 
+    @require_executed
+    def single_response(self):
+        '''Return a (server, client, response) tuple for a query that was sent
+        to a single server, from a single client.'''
+
+        server, client_response = next(iter(self.responses.items()))
+        client, response = next(iter(client_response.items()))
+        return server, client, response
+
     join = require_executed(DNSQuery.join)
     project = require_executed(DNSQuery.project)
     is_authoritative_answer_all = require_executed(DNSQuery.is_authoritative_answer_all)
@@ -24,22 +24,96 @@
 from __future__ import unicode_literals
 
 import bisect
+import codecs
+import collections
+import hashlib
 import io
+import json
 import math
+import os
 import random
+import struct
 import threading
 import time
 
+# python3/python2 dual compatibility
+try:
+    from time import monotonic
+except ImportError:
+    from time import time as monotonic
+
+# minimal support for python2.6
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+
+# LMDB is only needed for caching responses across processes
+try:
+    import lmdb
+except ImportError:
+    lmdb = None
+
 from . import query
+from .format import latin1_binary_to_string as lb2s
 from .ipaddr import *
 from . import response as Response
 from . import transport
 from . import util
 
-import dns.rdataclass, dns.exception, dns.message, dns.rcode, dns.resolver
+import dns.rdataclass, dns.rdatatype, dns.exception, dns.message, dns.rcode, dns.resolver
 
 MAX_CNAME_REDIRECTION = 20
 
+_resolv_conf_cache = {}
+_resolv_conf_cache_lock = threading.Lock()
+
+# an LMDB environment can only be opened once per process, so those opened
+# for shared caches are kept here, by process ID and path
+_shared_caches = {}
+_shared_caches_lock = threading.Lock()
+def _get_shared_cache(path):
+    key = os.getpid(), path
+    with _shared_caches_lock:
+        try:
+            return _shared_caches[key]
+        except KeyError:
+            pass
+        try:
+            env = lmdb.open(path, map_size=2**30, writemap=True)
+        except lmdb.Error:
+            # e.g., an environment inherited from the parent process, which
+            # cannot be used after fork(), still has the path open
+            env = None
+        _shared_caches[key] = env
+        return env
+
+def _close_shared_caches():
+    # An LMDB environment must not be used after fork(), so close them before
+    # forking.  Each process reopens them as needed.
+    with _shared_caches_lock:
+        for env in _shared_caches.values():
+            if env is not None:
+                env.close()
+        _shared_caches.clear()
+
+if lmdb is not None and hasattr(os, 'register_at_fork'):
+    os.register_at_fork(before=_close_shared_caches)
+
+def _shared_cache_value_expired(value, now):
+    try:
+        return json.loads(codecs.decode(value, 'utf-8'))['expiration'] <= now
+    except (ValueError, KeyError, TypeError):
+        return True
+
+def _prune_shared_cache(env):
+    # remove all expired (or unreadable) entries
+    now = time.time()
+    with env.begin(write=True) as txn:
+        expired = [key for key, value in txn.cursor() if _shared_cache_value_expired(value, now)]
+        for key in expired:
+            txn.delete(key)
+
 _r = None
 def get_standard_resolver():
     global _r
@@ -54,10 +128,38 @@ def get_dnssec_resolver():
         _rd = Resolver.from_file('/etc/resolv.conf', query.RecursiveDNSSECQuery)
     return _rd
 
-class DNSAnswer:
+def _follow_cname_chain(response, qname, rdtype, rdclass):
+    '''Follow the CNAME chain in the answer section of response, beginning
+    with qname.  Return a tuple of the RRset of type rdtype at the end of the
+    chain (or None, if there is none) and the last name in the chain.'''
+
+    # index the answer section once, rather than scanning it for every link
+    # in the CNAME chain.  As with find_rrset(), the first matching RRset
+    # wins.
+    answer_index = {}
+    for rrset in response.answer:
+        answer_index.setdefault((rrset.name, rrset.rdclass, rrset.rdtype, rrset.covers), rrset)
+
+    qname_sought = qname
+    names_sought = set()
+    while len(names_sought) < MAX_CNAME_REDIRECTION and qname_sought not in names_sought:
+        names_sought.add(qname_sought)
+        try:
+            return answer_index[(qname_sought, rdclass, rdtype, dns.rdatatype.NONE)], qname_sought
+        except KeyError:
+            try:
+                rrset = answer_index[(qname_sought, rdclass, dns.rdatatype.CNAME, dns.rdatatype.NONE)]
+                qname_sought = rrset[0].target
+            except KeyError:
+                break
+    return None, qname_sought
+
+class DNSAnswer(object):
     '''An answer to a DNS query, including the full DNS response message, the
     RRset requested, and the server.'''
 
+    __slots__ = ('response', 'server', 'rrset')
+
     def __init__(self, qname, rdtype, response, server):
         self.response = response
         self.server = server
@@ -66,19 +168,7 @@ class DNSAnswer:
 
         self._handle_nxdomain(response)
 
-        i = 0
-        qname_sought = qname
-        while i < MAX_CNAME_REDIRECTION:
-            try:
-                self.rrset = response.find_rrset(response.answer, qname_sought, dns.rdataclass.IN, rdtype)
-                i = MAX_CNAME_REDIRECTION
-            except KeyError:
-                try:
-                    rrset = response.find_rrset(response.answer, qname_sought, dns.rdataclass.IN, dns.rdatatype.CNAME)
-                    qname_sought = rrset[0].target
-                except KeyError:
-                    break
-            i += 1
+        self.rrset = _follow_cname_chain(response, qname, rdtype, dns.rdataclass.IN)[0]
 
         self._handle_noanswer()
 
@@ -94,17 +184,34 @@ class DNSAnswerNoAnswerAllowed(DNSAnswer):
     '''An answer to a DNS query, including the full DNS response message, the
     RRset requested, and the server.'''
 
+    __slots__ = ()
+
     def _handle_noanswer(self):
         pass
 
+class InFlightEntry:
+    def __init__(self):
+        self.event = threading.Event()
+        self.server_response = None
+
 class Resolver:
     '''A simple stub DNS resolver.'''
 
-    def __init__(self, servers, query_cls, timeout=1.0, max_attempts=5, lifetime=15.0, shuffle=False, client_ipv4=None, client_ipv6=None, port=53, transport_manager=None, th_factories=None):
+    # TCP connections to the resolver's servers are re-used across queries
+    default_th_factory = transport.DNSQueryTransportHandlerDNSPrivateFactory(pool_tcp=True)
+
+    def __init__(self, servers, query_cls, timeout=1.0, max_attempts=5, lifetime=15.0, shuffle=False, client_ipv4=None, client_ipv6=None, port=53, transport_manager=None, th_factories=None,
+            cache_size=1000, cache_min_ttl=0, cache_max_ttl=None, cache_neg_max_ttl=60, cache_path=None):
         if lifetime is None and max_attempts is None:
             raise ValueError("At least one of lifetime or max_attempts must be specified for a Resolver instance.")
 
         self._servers = servers
+        # each distinct server is assigned a bit, so the set of servers still
+        # valid for a query tuple can be tracked as an integer mask
+        self._server_bits = {}
+        for server in servers:
+            self._server_bits.setdefault(server, 1 << len(self._server_bits))
+        self._all_servers_mask = (1 << len(self._server_bits)) - 1
         self._query_cls = query_cls
         self._timeout = timeout
         self._max_attempts = max_attempts
@@ -114,10 +221,34 @@ class Resolver:
         self._client_ipv6 = client_ipv6
         self._port = port
         self._transport_manager = transport_manager
-        self._th_factories = th_factories
+        if th_factories is None:
+            self._th_factories = (self.default_th_factory,)
+        else:
+            self._th_factories = th_factories
+
+        self._cache_size = cache_size
+        self._cache_min_ttl = cache_min_ttl
+        self._cache_max_ttl = cache_max_ttl
+        self._cache_neg_max_ttl = cache_neg_max_ttl
+        self._pos_cache = OrderedDict()
+        self._neg_cache = OrderedDict()
+        self._cache_lock = threading.Lock()
+
+        # if a cache path is given (and LMDB is available), then responses
+        # are also cached in an LMDB environment at that path, which is
+        # shared by every Resolver (in any process) that uses the same path
+        # and issues the same queries
+        if cache_path is not None and cache_size and lmdb is not None:
+            self._shared_cache_path = cache_path
+            self._shared_cache_prefix = self._shared_cache_fingerprint()
+        else:
+            self._shared_cache_path = None
+
+        self._inflight = {}
+        self._inflight_lock = threading.Lock()
 
     @classmethod
-    def from_file(cls, resolv_conf, query_cls, **kwargs):
+    def _servers_from_file(cls, resolv_conf):
         servers = []
         try:
             with io.open(resolv_conf, 'r', encoding='utf-8') as f:
@@ -131,7 +262,274 @@ class Resolver:
                             pass
         except IOError:
             pass
-        return Resolver(servers, query_cls, **kwargs)
+        return servers
+
+    @classmethod
+    def from_file(cls, resolv_conf, query_cls, **kwargs):
+        # re-use the servers parsed previously from the file, unless it has
+        # since been modified
+        try:
+            mtime = os.stat(resolv_conf).st_mtime
+        except OSError:
+            servers = []
+        else:
+            with _resolv_conf_cache_lock:
+                try:
+                    cached_mtime, servers = _resolv_conf_cache[resolv_conf]
+                except KeyError:
+                    cached_mtime = None
+                if cached_mtime != mtime:
+                    servers = cls._servers_from_file(resolv_conf)
+                    _resolv_conf_cache[resolv_conf] = mtime, servers
+        return Resolver(list(servers), query_cls, **kwargs)
+
+    def flush_cache(self):
+        '''Remove all cached responses, including those in the shared cache
+        that were stored by Resolvers with the same configuration as this
+        one.'''
+
+        with self._cache_lock:
+            self._pos_cache = OrderedDict()
+            self._neg_cache = OrderedDict()
+
+        if self._shared_cache_path is not None:
+            self._shared_cache_flush()
+
+    def _cache_get(self, query_tuple):
+        t = monotonic()
+
+        with self._cache_lock:
+            for cache in (self._pos_cache, self._neg_cache):
+                try:
+                    expiration, server_response = cache.pop(query_tuple)
+                except KeyError:
+                    continue
+
+                # the entry has expired, so leave it out
+                if expiration <= t:
+                    continue
+
+                # re-insert the entry, so it is marked as most recently used
+                cache[query_tuple] = expiration, server_response
+                return server_response
+
+        if self._shared_cache_path is not None:
+            return self._shared_cache_get(query_tuple)
+
+        return None
+
+    def _cache_ttl(self, query_tuple, response):
+        '''Return a tuple of (negative, ttl) for caching response, where
+        negative indicates whether it is a negative response, or None, if the
+        response should not be cached.'''
+
+        # only complete responses with a sane rcode are cached
+        if response is None or not (response.is_complete_response() and response.is_valid_response()):
+            return None
+
+        msg = response.message
+        # a response is only positive if the CNAME chain (if any) ends in an
+        # RRset of the type queried, as it does for DNSAnswer
+        rrset, qname_sought = _follow_cname_chain(msg, query_tuple[0], query_tuple[1], query_tuple[2])
+        if msg.rcode() == dns.rcode.NOERROR and rrset is not None:
+            negative = False
+            ttl = min([x.ttl for x in msg.answer])
+            max_ttl = self._cache_max_ttl
+        else:
+            # NXDOMAIN or NODATA responses are cached with the lesser of the
+            # SOA TTL and SOA minimum, for the SOA of the last name in the
+            # chain.  Without an SOA they are not cached at all (RFC 2308,
+            # sections 3 and 5).
+            try:
+                soa_rrset = [x for x in msg.authority if qname_sought.is_subdomain(x.name) and x.rdtype == dns.rdatatype.SOA][0]
+            except IndexError:
+                return None
+            negative = True
+            ttl = min([soa_rrset.ttl, soa_rrset[0].minimum] + [x.ttl for x in msg.answer])
+            max_ttl = self._cache_neg_max_ttl
+
+        ttl = max(ttl, self._cache_min_ttl)
+        if max_ttl is not None and ttl > max_ttl:
+            ttl = max_ttl
+        if ttl <= 0:
+            return None
+        return negative, ttl
+
+    def _cache_insert(self, query_tuple, server_response, negative, ttl):
+        if negative:
+            cache = self._neg_cache
+        else:
+            cache = self._pos_cache
+
+        expiration = monotonic() + ttl
+
+        with self._cache_lock:
+            self._pos_cache.pop(query_tuple, None)
+            self._neg_cache.pop(query_tuple, None)
+            cache[query_tuple] = expiration, server_response
+            # evict the least recently used entries
+            while len(cache) > self._cache_size:
+                cache.popitem(last=False)
+
+    def _cache_put(self, query_tuple, server_response, shared_writes=None):
+        if not self._cache_size:
+            return
+
+        server, response = server_response
+        negative_ttl = self._cache_ttl(query_tuple, response)
+        if negative_ttl is None:
+            return
+        negative, ttl = negative_ttl
+
+        self._cache_insert(query_tuple, server_response, negative, ttl)
+
+        if self._shared_cache_path is not None and shared_writes is not None:
+            # entries in the shared cache expire by wall-clock time, since the
+            # monotonic clock is not comparable across processes
+            d = OrderedDict()
+            d['expiration'] = time.time() + ttl
+            d['negative'] = negative
+            d['server'] = server
+            d['server_cookie_status'] = response.server_cookie_status
+            d['response'] = response.serialize()
+            shared_writes.append((self._shared_cache_key(query_tuple), codecs.encode(json.dumps(d), 'utf-8')))
+
+    def _shared_cache_fingerprint(self):
+        '''Return a digest of everything that determines the queries issued by
+        this Resolver, other than the query tuple itself.'''
+
+        query_cls = self._query_cls
+        edns_options = []
+        for opt in getattr(query_cls, 'edns_options', []):
+            buf = io.BytesIO()
+            opt.to_wire(buf)
+            edns_options.append((opt.otype, lb2s(codecs.encode(buf.getvalue(), 'hex'))))
+
+        d = OrderedDict()
+        d['query_cls'] = '%s.%s' % (query_cls.__module__, query_cls.__name__)
+        d['flags'] = getattr(query_cls, 'flags', None)
+        d['edns'] = getattr(query_cls, 'edns', None)
+        d['edns_max_udp_payload'] = getattr(query_cls, 'edns_max_udp_payload', None)
+        d['edns_flags'] = getattr(query_cls, 'edns_flags', None)
+        d['edns_options'] = edns_options
+        d['tcp'] = getattr(query_cls, 'tcp', None)
+        d['servers'] = sorted(set([str(server) for server in self._servers]))
+        d['port'] = self._port
+        d['client_ipv4'] = None if self._client_ipv4 is None else str(self._client_ipv4)
+        d['client_ipv6'] = None if self._client_ipv6 is None else str(self._client_ipv6)
+        return hashlib.sha1(codecs.encode(json.dumps(d), 'utf-8')).digest()
+
+    def _shared_cache_key(self, query_tuple):
+        return self._shared_cache_prefix + query_tuple[0].to_digestable() + struct.pack(b'!HH', query_tuple[1], query_tuple[2])
+
+    def _shared_cache_get(self, query_tuple):
+        env = _get_shared_cache(self._shared_cache_path)
+        if env is None:
+            return None
+
+        key = self._shared_cache_key(query_tuple)
+        try:
+            with env.begin() as txn:
+                value = txn.get(key)
+        except lmdb.Error:
+            return None
+        if value is None:
+            return None
+
+        try:
+            d = json.loads(codecs.decode(value, 'utf-8'))
+            ttl = d['expiration'] - time.time()
+            if ttl <= 0:
+                self._shared_cache_delete(env, key, value)
+                return None
+
+            server = IPAddr(d['server'])
+            if server not in self._server_bits:
+                return None
+            q = self._query_cls(query_tuple[0], query_tuple[1], query_tuple[2], server, None, client_ipv4=self._client_ipv4, client_ipv6=self._client_ipv6, port=self._port, executable=False)
+            response = Response.DNSResponse.deserialize(d['response'], q, None, d['server_cookie_status'])
+            negative = d['negative']
+        except (ValueError, KeyError, TypeError):
+            # the entry is truncated or in an unknown format
+            self._shared_cache_delete(env, key, value)
+            return None
+
+        server_response = server, response
+        self._cache_insert(query_tuple, server_response, negative, ttl)
+        return server_response
+
+    @classmethod
+    def _shared_cache_delete(cls, env, key, value):
+        try:
+            with env.begin(write=True) as txn:
+                # only delete the entry if another process hasn't replaced it
+                # in the meantime
+                if txn.get(key) == value:
+                    txn.delete(key)
+        except lmdb.Error:
+            pass
+
+    def _shared_cache_flush(self):
+        env = _get_shared_cache(self._shared_cache_path)
+        if env is None:
+            return
+
+        prefix = self._shared_cache_prefix
+        try:
+            with env.begin(write=True) as txn:
+                cursor = txn.cursor()
+                keys = []
+                if cursor.set_range(prefix):
+                    for key in cursor.iternext(values=False):
+                        if not key.startswith(prefix):
+                            break
+                        keys.append(key)
+                for key in keys:
+                    txn.delete(key)
+        except lmdb.Error:
+            pass
+
+    @classmethod
+    def _shared_cache_write(cls, env, shared_writes):
+        with env.begin(write=True) as txn:
+            for key, value in shared_writes:
+                txn.put(key, value)
+
+    def _shared_cache_put(self, shared_writes):
+        env = _get_shared_cache(self._shared_cache_path)
+        if env is None:
+            return
+
+        try:
+            self._shared_cache_write(env, shared_writes)
+        except lmdb.MapFullError:
+            # make room by removing the expired entries, and try once more
+            try:
+                _prune_shared_cache(env)
+                self._shared_cache_write(env, shared_writes)
+            except lmdb.Error:
+                pass
+        except lmdb.Error:
+            # the entries are still cached locally
+            pass
+
+    def _claim_inflight(self, key):
+        '''Return a tuple of the in-flight entry for key and a boolean
+        indicating whether the caller is now responsible for querying it
+        (True) or another caller already is (False).'''
+
+        with self._inflight_lock:
+            try:
+                return self._inflight[key], False
+            except KeyError:
+                entry = self._inflight[key] = InFlightEntry()
+                return entry, True
+
+    def _release_inflight(self, key, server_response):
+        with self._inflight_lock:
+            entry = self._inflight.pop(key)
+        entry.server_response = server_response
+        entry.event.set()
 
     def query(self, qname, rdtype, rdclass=dns.rdataclass.IN, accept_first_response=False, continue_on_servfail=True):
         return list(self.query_multiple((qname, rdtype, rdclass), accept_first_response=accept_first_response, continue_on_servfail=continue_on_servfail).values())[0]
@@ -175,75 +573,103 @@ class Resolver:
         valid_servers = {}
         responses = {}
         last_responses = {}
-        attempts = {}
+        server_queues = {}
+        cycle_counts = {}
+        query_map = {}
+        inflight_keys = {}
+        inflight_waiting = {}
+        shared_writes = []
 
         accept_first_response = kwargs.get('accept_first_response', False)
         continue_on_servfail = kwargs.get('continue_on_servfail', True)
 
-        query_tuples = set(query_tuples)
-        for query_tuple in query_tuples:
-            attempts[query_tuple] = 0
-            valid_servers[query_tuple] = set(self._servers)
-
         if self._shuffle:
             servers = self._servers[:]
             random.shuffle(servers)
         else:
             servers = self._servers
 
-        tuples_to_query = query_tuples.difference(last_responses)
-        start = time.time()
-        while tuples_to_query and (self._lifetime is None or time.time() - start < self._lifetime):
-            now = time.time()
-            queries = {}
-            for query_tuple in tuples_to_query:
-                if not valid_servers[query_tuple]:
-                    try:
-                        last_responses[query_tuple] = responses[query_tuple]
-                    except KeyError:
-                        last_responses[query_tuple] = None, None
-                    continue
+        # every attempt for a query tuple takes the next server from its
+        # queue, which holds the servers in order, and rotates it to the back.
+        # Each server gets a turn at most max_attempts times.
+        if self._max_attempts is not None:
+            max_cycles = self._max_attempts * len(servers)
+        else:
+            max_cycles = None
 
-                while query_tuple not in queries:
-                    cycle_num, server_index = divmod(attempts[query_tuple], len(servers))
-                    # if we've exceeded our maximum attempts, then break out
-                    if cycle_num >= self._max_attempts:
-                        try:
-                            last_responses[query_tuple] = responses[query_tuple]
-                        except KeyError:
-                            last_responses[query_tuple] = None, None
-                        break
+        server_bits = self._server_bits
+        timeout_cap = self._timeout
+        if self._lifetime is not None:
+            deadline = monotonic() + self._lifetime
+        else:
+            deadline = None
 
-                    server = servers[server_index]
-                    if server in valid_servers[query_tuple]:
-                        if self._lifetime is not None:
-                            timeout = min(self._timeout, max((start + self._lifetime) - now, 0))
-                        else:
-                            timeout = self._timeout
-                        q = self._query_cls(query_tuple[0], query_tuple[1], query_tuple[2], server, None, client_ipv4=self._client_ipv4, client_ipv6=self._client_ipv6, port=self._port, query_timeout=timeout, max_attempts=1)
-                        queries[query_tuple] = q
-
-                    attempts[query_tuple] += 1
-
-            query.ExecutableDNSQuery.execute_queries(*list(queries.values()), tm=self._transport_manager, th_factories=self._th_factories)
-
-            for query_tuple, q in queries.items():
-                # no response means we didn't even try because we don't have
-                # proper connectivity
-                if not q.responses:
-                    server = list(q.servers)[0]
-                    valid_servers[query_tuple].remove(server)
-                    if not valid_servers[query_tuple]:
-                        last_responses[query_tuple] = server, None
+        def _accept(query_tuple, server_response):
+            last_responses[query_tuple] = server_response
+            self._cache_put(query_tuple, server_response, shared_writes)
+            self._release_inflight(inflight_keys.pop(query_tuple), server_response)
+
+        def _finish(query_tuple):
+            try:
+                _accept(query_tuple, responses[query_tuple])
+            except KeyError:
+                _accept(query_tuple, (None, None))
+
+        def _next_query(query_tuple):
+            # Return the query for the next attempt of query_tuple, or None, if
+            # there are no attempts left, in which case the most recent
+            # response is accepted.
+            if deadline is not None:
+                remaining = deadline - monotonic()
+                if remaining <= 0:
+                    _finish(query_tuple)
+                    return None
+                timeout = min(timeout_cap, remaining)
+            else:
+                timeout = timeout_cap
+
+            # once every server has had max_attempts turns, we've exceeded our
+            # maximum attempts
+            server_queue = server_queues[query_tuple]
+            while valid_servers[query_tuple] and \
+                    (max_cycles is None or cycle_counts[query_tuple] < max_cycles):
+                server = server_queue.popleft()
+                server_queue.append(server)
+                cycle_counts[query_tuple] += 1
+                if not valid_servers[query_tuple] & server_bits[server]:
                     continue
 
-                server, client_response = list(q.responses.items())[0]
-                client, response = list(client_response.items())[0]
+                q = self._query_cls(query_tuple[0], query_tuple[1], query_tuple[2], server, None, client_ipv4=self._client_ipv4, client_ipv6=self._client_ipv6, port=self._port, query_timeout=timeout, max_attempts=1)
+                query_map[q] = query_tuple
+                return q
+
+            _finish(query_tuple)
+            return None
+
+        def _handle_query(q):
+            # Handle the response to a single attempt, as soon as it is
+            # available, and return the query for the next attempt, if one is
+            # needed.  Attempts for different query tuples thus proceed
+            # independently of one another, rather than in lock step.
+            query_tuple = query_map.pop(q)
+
+            # no response means we didn't even try because we don't have
+            # proper connectivity
+            if not q.responses:
+                server = next(iter(q.servers))
+                valid_servers[query_tuple] &= ~server_bits[server]
+                if not valid_servers[query_tuple]:
+                    _accept(query_tuple, (server, None))
+                    return []
+
+            else:
+                server, client, response = q.single_response()
                 responses[query_tuple] = (server, response)
                 # if we received a complete message with an acceptable rcode,
                 # then accept it as the last response
                 if response.is_complete_response() and response.is_valid_response():
-                    last_responses[query_tuple] = responses[query_tuple]
+                    _accept(query_tuple, responses[query_tuple])
+                    return []
                 # if we received a message that was incomplete (i.e.,
                 # truncated), had an invalid rcode, was malformed, or was
                 # otherwise invalid, then accept the response (if directed),
@@ -252,18 +678,71 @@ class Resolver:
                         response.error not in (query.RESPONSE_ERROR_TIMEOUT, query.RESPONSE_ERROR_NETWORK_ERROR):
                     # accept_first_response is true, then accept the response
                     if accept_first_response:
-                        last_responses[query_tuple] = responses[query_tuple]
+                        _accept(query_tuple, responses[query_tuple])
+                        return []
                     # if the response was SERVFAIL, and we were not directed to
                     # continue, then accept the response
                     elif response.message is not None and \
                             response.message.rcode() == dns.rcode.SERVFAIL and not continue_on_servfail:
-                        last_responses[query_tuple] = responses[query_tuple]
-                    valid_servers[query_tuple].remove(server)
+                        _accept(query_tuple, responses[query_tuple])
+                        return []
+                    valid_servers[query_tuple] &= ~server_bits[server]
 
-            tuples_to_query = query_tuples.difference(last_responses)
+            next_q = _next_query(query_tuple)
+            if next_q is None:
+                return []
+            return [next_q]
 
-        for query_tuple in tuples_to_query:
-            last_responses[query_tuple] = responses[query_tuple]
+        queries = []
+        try:
+            for query_tuple in set(query_tuples):
+                # use the cached response, if there is an unexpired one
+                server_response = self._cache_get(query_tuple)
+                if server_response is not None:
+                    last_responses[query_tuple] = server_response
+                    continue
+
+                # if another caller is already querying the same tuple, then
+                # wait for its response, rather than sending the same queries
+                inflight_key = (query_tuple, accept_first_response, continue_on_servfail)
+                entry, is_owner = self._claim_inflight(inflight_key)
+                if not is_owner:
+                    inflight_waiting[query_tuple] = entry
+                    continue
+                inflight_keys[query_tuple] = inflight_key
+
+                server_queues[query_tuple] = collections.deque(servers)
+                cycle_counts[query_tuple] = 0
+                valid_servers[query_tuple] = self._all_servers_mask
+                q = _next_query(query_tuple)
+                if q is not None:
+                    queries.append(q)
+
+            if queries:
+                query.ExecutableDNSQuery.execute_queries(*queries, tm=self._transport_manager, th_factories=self._th_factories, completion_callback=_handle_query)
+        finally:
+            # if any claimed tuples were left unresolved (i.e., because of an
+            # exception), then release them, so other callers don't wait on
+            # them indefinitely
+            for query_tuple in list(inflight_keys):
+                self._release_inflight(inflight_keys.pop(query_tuple), None)
+
+        # write all newly cached responses to the shared cache at once
+        if shared_writes:
+            self._shared_cache_put(shared_writes)
+
+        # Our own queries are done, so now collect the responses for those
+        # issued by other callers.  Any that came up empty-handed are queried
+        # anew.
+        requery_tuples = []
+        for query_tuple, entry in inflight_waiting.items():
+            entry.event.wait()
+            if entry.server_response is None:
+                requery_tuples.append(query_tuple)
+            else:
+                last_responses[query_tuple] = entry.server_response
+        if requery_tuples:
+            last_responses.update(self.query_multiple(*requery_tuples, **kwargs))
 
         return last_responses
 
@@ -578,8 +1057,7 @@ class FullResolver:
                             # No network connectivity
                             continue
 
-                        server1, client_response = list(q.responses.items())[0]
-                        client, response = list(client_response.items())[0]
+                        server1, client, response = q.single_response()
 
                         server_cookie = response.get_server_cookie()
                         if server_cookie is not None:
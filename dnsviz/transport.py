@@ -24,10 +24,10 @@
 from __future__ import unicode_literals
 
 import base64
-import bisect
 import codecs
 import errno
 import fcntl
+import heapq
 import io
 import json
 import os
@@ -40,6 +40,7 @@ import struct
 import subprocess
 import threading
 import time
+import weakref
 
 # minimal support for python2.6
 try:
@@ -71,6 +72,7 @@ DNS_TRANSPORT_VERSION = 1.0
 
 MAX_PORT_BIND_ATTEMPTS=10
 MAX_WAIT_FOR_REQUEST=30
+TCP_IDLE_TIMEOUT=10
 HTTP_HEADER_END_RE = re.compile(r'(\r\n\r\n|\n\n|\r\r)')
 HTTP_STATUS_RE = re.compile(r'^HTTP/\S+ (?P<status>\d+) ')
 CONTENT_LENGTH_RE = re.compile(r'^Content-Length: (?P<length>\d+)', re.MULTILINE)
@@ -78,6 +80,17 @@ CHUNKED_ENCODING_RE = re.compile(r'^Transfer-Encoding: chunked(\r\n|\r|\n)', re.
 CHUNK_SIZE_RE = re.compile(r'^(?P<length>[0-9a-fA-F]+)(;[^\r\n]+)?(\r\n|\r|\n)')
 CRLF_START_RE = re.compile(r'^(\r\n|\n|\r)')
 
+# factories holding idle TCP connections, so they can be closed by the
+# transport manager, even if no further TCP queries are issued
+_tcp_pool_factories = weakref.WeakSet()
+_tcp_pool_factories_lock = threading.Lock()
+
+def _expire_pooled_tcp_socks(close_all=False):
+    with _tcp_pool_factories_lock:
+        factories = list(_tcp_pool_factories)
+    for factory in factories:
+        factory.expire_tcp_socks(close_all)
+
 class SocketWrapper(object):
     def __init__(self):
         raise NotImplemented
@@ -531,6 +544,13 @@ class DNSQueryTransportHandler(object):
         if self._processed_queue is not None:
             self._processed_queue.put(self)
 
+    def reconnect(self):
+        '''If the error encountered can be resolved by re-sending the request
+        over a new connection, then establish that connection and return
+        True.  Otherwise, return False.'''
+
+        return False
+
     def do_write(self):
         try:
             self.msg_send_index += self.sock.send(self.msg_send[self.msg_send_index:])
@@ -565,6 +585,68 @@ class DNSQueryTransportHandlerDNS(DNSQueryTransportHandler):
 
     require_queryid_match = True
 
+    def __init__(self, *args, **kwargs):
+        super(DNSQueryTransportHandlerDNS, self).__init__(*args, **kwargs)
+        self._tcp_pool_key = None
+        self._reused_tcp_sock = False
+
+    def prepare(self):
+        # if there is an idle TCP connection to the same server, then use
+        # that, rather than establishing a new one.  Queries with a specific
+        # source port always get a new connection.
+        if self.transport_type == socket.SOCK_STREAM and self.factory is not None and \
+                self.factory.pool_tcp and self._sock is None and self.sport is None:
+            self._tcp_pool_key = (self.dst, self.dport, self.src)
+            self.sock = self.factory.checkout_tcp_sock(self._tcp_pool_key)
+            if self.sock is not None:
+                self._reused_tcp_sock = True
+                self._init_msg_recv()
+                self._set_start_time()
+                return
+
+        super(DNSQueryTransportHandlerDNS, self).prepare()
+
+    def reconnect(self):
+        # An idle connection might be closed by the server after it was
+        # checked, but before (or while) the request was sent over it.  That
+        # is not a failure of the server, so if nothing has been received,
+        # then try once more, over a new connection.
+        if not self._reused_tcp_sock or self.msg_recv or self.msg_recv_buf:
+            return False
+        self._reused_tcp_sock = False
+
+        old_sock = self.sock
+        try:
+            self._create_socket()
+            self._configure_socket()
+            self._bind_socket()
+            self._connect_socket()
+        except socket.error:
+            # report the original error
+            if self.sock is not old_sock:
+                self.sock.close()
+                self.sock = old_sock
+            return False
+
+        old_sock.close()
+        self.err = None
+        self.msg_send_index = 0
+        self._init_msg_recv()
+        return True
+
+    def cleanup(self):
+        # if the TCP exchange completed cleanly, then return the connection to
+        # the pool for re-use, rather than closing it
+        if self._tcp_pool_key is not None and self.sock is not None and self.err is None:
+            self._set_end_time()
+            self._set_socket_info()
+            self.factory.checkin_tcp_sock(self._tcp_pool_key, self.sock)
+            if self._processed_queue is not None:
+                self._processed_queue.put(self)
+            return
+
+        super(DNSQueryTransportHandlerDNS, self).cleanup()
+
     def finalize(self):
         super(DNSQueryTransportHandlerDNS, self).finalize()
         qtm = self.qtms[0]
@@ -1267,15 +1349,94 @@ class DNSQueryTransportHandlerFactory(object):
     cls = DNSQueryTransportHandler
 
     def __init__(self, *args, **kwargs):
+        # if pool_tcp is True, then TCP connections are kept open after a
+        # clean exchange and re-used by later queries to the same server.
+        # This is off by default, so diagnostic queries always get a fresh
+        # connection.
+        self.pool_tcp = kwargs.pop('pool_tcp', False)
         self.args = args
         self.kwargs = kwargs
         self.kwargs['factory'] = self
         self.lock = threading.Lock()
         self.sock = None
+        self._tcp_pool = {}
 
     def __del__(self):
         if self.sock is not None:
             self.sock.close()
+        for key in self._tcp_pool:
+            for sock, last_used in self._tcp_pool[key]:
+                sock.close()
+
+    def _expire_tcp_socks(self, close_all=False):
+        t = time.time()
+        for key in list(self._tcp_pool):
+            live_socks = []
+            for sock, last_used in self._tcp_pool[key]:
+                if not close_all and t - last_used < TCP_IDLE_TIMEOUT:
+                    live_socks.append((sock, last_used))
+                else:
+                    sock.close()
+            if live_socks:
+                self._tcp_pool[key] = live_socks
+            else:
+                del self._tcp_pool[key]
+
+    def expire_tcp_socks(self, close_all=False):
+        '''Close the idle TCP connections that have expired, or all of them,
+        if close_all is True.'''
+
+        self.lock.acquire()
+        try:
+            self._expire_tcp_socks(close_all)
+            if not self._tcp_pool:
+                with _tcp_pool_factories_lock:
+                    _tcp_pool_factories.discard(self)
+        finally:
+            self.lock.release()
+
+    @classmethod
+    def _is_idle_sock_usable(cls, sock):
+        # An idle connection should have nothing to read.  If it does, then
+        # either the server closed the connection (empty read) or it sent
+        # something unsolicited, and in either case it shouldn't be re-used.
+        try:
+            sock.sock.recv(1, socket.MSG_PEEK)
+        except socket.error as e:
+            return e.errno in (errno.EAGAIN, errno.EWOULDBLOCK)
+        return False
+
+    def checkout_tcp_sock(self, key):
+        '''Return an idle TCP connection for key, a tuple of (dst, dport, src),
+        removing it from the pool, or None, if there is none.'''
+
+        self.lock.acquire()
+        try:
+            self._expire_tcp_socks()
+            socks = self._tcp_pool.get(key, [])
+            while socks:
+                sock, last_used = socks.pop()
+                if self._is_idle_sock_usable(sock):
+                    return sock
+                sock.close()
+            return None
+        finally:
+            self.lock.release()
+
+    def checkin_tcp_sock(self, key, sock):
+        '''Return a TCP connection to the pool, for re-use by a later query
+        with the same key.'''
+
+        self.lock.acquire()
+        try:
+            self._expire_tcp_socks()
+            if key not in self._tcp_pool:
+                self._tcp_pool[key] = []
+            self._tcp_pool[key].append((sock, time.time()))
+            with _tcp_pool_factories_lock:
+                _tcp_pool_factories.add(self)
+        finally:
+            self.lock.release()
 
     def build(self, **kwargs):
         if 'sock' not in kwargs and self.sock is not None:
@@ -1362,6 +1523,9 @@ class DNSQueryTransportHandlerWrapper(object):
 class _DNSQueryTransportManager:
     '''A class that handles'''
 
+    _running = 0
+    _running_lock = threading.Lock()
+
     #TODO might need FD_SETSIZE to support lots of fds
     def __init__(self):
         self._notify_read_fd, self._notify_write_fd = os.pipe()
@@ -1370,6 +1534,8 @@ class _DNSQueryTransportManager:
         self._event_map = {}
 
         self._close = threading.Event()
+        with self._running_lock:
+            _DNSQueryTransportManager._running += 1
         t = threading.Thread(target=self._loop)
         t.start()
 
@@ -1391,10 +1557,42 @@ class _DNSQueryTransportManager:
         if notify:
             os.write(self._notify_write_fd, struct.pack(b'!B', 0))
 
+    def _reconnect(self, qh, query_meta, rlist_in, wlist_in):
+        # if the handler re-sends its request over a new connection, then
+        # replace its fds with those of the new connection
+        reader_fd = qh.sock.reader_fd
+        writer_fd = qh.sock.writer_fd
+        if not qh.reconnect():
+            return False
+
+        for fd, fd_list in ((reader_fd, rlist_in), (writer_fd, wlist_in)):
+            try:
+                fd_list.remove(fd)
+            except ValueError:
+                pass
+            query_meta.pop(fd, None)
+
+        query_meta[qh.sock.reader_fd] = qh
+        query_meta[qh.sock.writer_fd] = qh
+        wlist_in.append(qh.sock.writer_fd)
+        return True
+
     def _loop(self):
         '''Return the data resulting from a UDP transaction.'''
 
+        try:
+            self._loop_inner()
+        finally:
+            # once no transport managers are running, nothing closes idle TCP
+            # connections, so close them all now
+            with self._running_lock:
+                _DNSQueryTransportManager._running -= 1
+                if not _DNSQueryTransportManager._running:
+                    _expire_pooled_tcp_socks(True)
+
+    def _loop_inner(self):
         query_meta = {}
+        # min-heap of (expiration, wrapped qh)
         expirations = []
 
         # initialize "in" fds for select
@@ -1402,12 +1600,15 @@ class _DNSQueryTransportManager:
         wlist_in = []
         xlist_in = []
 
+        next_tcp_expiration = time.time() + TCP_IDLE_TIMEOUT
+
         while True:
             # determine the new expiration
             if expirations:
                 timeout = max(expirations[0][0] - time.time(), 0)
             else:
                 timeout = MAX_WAIT_FOR_REQUEST
+            timeout = min(timeout, max(next_tcp_expiration - time.time(), 0))
 
             finished_fds = []
 
@@ -1417,12 +1618,19 @@ class _DNSQueryTransportManager:
             if self._close.is_set():
                 break
 
+            # close idle TCP connections that have expired
+            if time.time() >= next_tcp_expiration:
+                _expire_pooled_tcp_socks()
+                next_tcp_expiration = time.time() + TCP_IDLE_TIMEOUT
+
             # handle the requests
             for fd in wlist_out:
                 qh = query_meta[fd]
 
                 if qh.do_write():
-                    if qh.err is not None or qh.mode == QTH_MODE_WRITE:
+                    if qh.err is not None and self._reconnect(qh, query_meta, rlist_in, wlist_in):
+                        pass
+                    elif qh.err is not None or qh.mode == QTH_MODE_WRITE:
                         qh.cleanup()
                         finished_fds.append(fd)
                     else: # qh.mode == QTH_MODE_WRITE_READ
@@ -1437,13 +1645,15 @@ class _DNSQueryTransportManager:
                 qh = query_meta[fd]
 
                 if qh.do_read(): # qh.mode in (QTH_MODE_WRITE_READ, QTH_MODE_READ)
+                    if qh.err is not None and self._reconnect(qh, query_meta, rlist_in, wlist_in):
+                        continue
                     qh.cleanup()
                     finished_fds.append(qh.sock.reader_fd)
 
             # handle the expired queries
-            future_index = bisect.bisect_right(expirations, ((time.time(), DNSQueryTransportHandlerWrapper(None))))
-            for i in range(future_index):
-                qh = expirations[i][1].qh
+            now = time.time()
+            while expirations and expirations[0][0] <= now:
+                qh = heapq.heappop(expirations)[1].qh
 
                 # this query actually finished earlier in this iteration of the
                 # loop, so don't indicate that it timed out
@@ -1453,7 +1663,6 @@ class _DNSQueryTransportManager:
                 qh.do_timeout()
                 qh.cleanup()
                 finished_fds.append(qh.sock.reader_fd)
-            expirations = expirations[future_index:]
 
             # for any fds that need to be finished, do it now
             for fd in finished_fds:
@@ -1497,7 +1706,7 @@ class _DNSQueryTransportManager:
                             # socket, then put this socket in the write fd list
                             query_meta[qh.sock.reader_fd] = qh
                             query_meta[qh.sock.writer_fd] = qh
-                            bisect.insort(expirations, (qh.expiration, DNSQueryTransportHandlerWrapper(qh)))
+                            heapq.heappush(expirations, (qh.expiration, DNSQueryTransportHandlerWrapper(qh)))
                             if qh.mode in (QTH_MODE_WRITE_READ, QTH_MODE_WRITE):
                                 wlist_in.append(qh.sock.writer_fd)
                             elif qh.mode == QTH_MODE_READ:
@@ -0,0 +1,321 @@
+import shutil
+import socket
+import struct
+import tempfile
+import threading
+import time
+import unittest
+
+import dns.flags, dns.message, dns.name, dns.rcode, dns.rdataclass, dns.rdatatype, dns.rrset, dns.resolver
+
+from dnsviz import query, resolver, transport
+from dnsviz.ipaddr import IPAddr
+
+A = dns.rdatatype.A
+IN = dns.rdataclass.IN
+SERVER = IPAddr('127.0.0.1')
+
+def _name(s):
+    return dns.name.from_text(s)
+
+def _soa(zone, ttl=300, minimum=300):
+    return dns.rrset.from_text(zone, ttl, 'IN', 'SOA', 'ns.%s hostmaster.%s 1 3600 600 86400 %d' % (zone, zone, minimum))
+
+def default_answer(request, tcp):
+    '''Answer most queries with an A record.  The first label of the name
+    selects other behavior.'''
+
+    response = dns.message.make_response(request)
+    qname = request.question[0].name
+    label = qname.labels[0]
+    if label == b'nx':
+        response.set_rcode(dns.rcode.NXDOMAIN)
+        response.authority.append(_soa('example.', 3600, 3600))
+    elif label == b'cnodata':
+        # a CNAME chain that ends in NODATA
+        response.answer.append(dns.rrset.from_text(qname, 86400, 'IN', 'CNAME', 'target.other.'))
+        response.authority.append(_soa('other.', 86400, 86400))
+    elif label == b'cnodatanosoa':
+        response.answer.append(dns.rrset.from_text(qname, 86400, 'IN', 'CNAME', 'target.other.'))
+    elif label == b'short':
+        response.answer.append(dns.rrset.from_text(qname, 1, 'IN', 'A', '192.0.2.1'))
+    elif label.startswith(b'tc') and not tcp:
+        response.flags |= dns.flags.TC
+    else:
+        response.answer.append(dns.rrset.from_text(qname, 300, 'IN', 'A', '192.0.2.1'))
+    return response
+
+class Responder(object):
+    '''A DNS server listening on UDP and TCP on the same port of 127.0.0.1,
+    answering each query with the result of answer(request, tcp).'''
+
+    def __init__(self, answer=default_answer, delay=0, close_after_response=False):
+        self.answer = answer
+        self.delay = delay
+        self.close_after_response = close_after_response
+        self.queries = []
+        self.tcp_connections = 0
+        self._lock = threading.Lock()
+
+        self._udp_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self._udp_sock.bind(('127.0.0.1', 0))
+        self.port = self._udp_sock.getsockname()[1]
+        self._tcp_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._tcp_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._tcp_sock.bind(('127.0.0.1', self.port))
+        self._tcp_sock.listen(16)
+
+        for target in (self._serve_udp, self._serve_tcp):
+            t = threading.Thread(target=target)
+            t.daemon = True
+            t.start()
+
+    def close(self):
+        self._udp_sock.close()
+        self._tcp_sock.close()
+
+    def _respond(self, wire, tcp):
+        request = dns.message.from_wire(wire)
+        with self._lock:
+            self.queries.append((request.question[0].name, tcp))
+        if self.delay:
+            time.sleep(self.delay)
+        return self.answer(request, tcp).to_wire()
+
+    def _serve_udp(self):
+        while True:
+            try:
+                wire, addr = self._udp_sock.recvfrom(65535)
+            except socket.error:
+                return
+            self._udp_sock.sendto(self._respond(wire, False), addr)
+
+    def _serve_tcp(self):
+        while True:
+            try:
+                conn, addr = self._tcp_sock.accept()
+            except socket.error:
+                return
+            with self._lock:
+                self.tcp_connections += 1
+            t = threading.Thread(target=self._serve_tcp_conn, args=(conn,))
+            t.daemon = True
+            t.start()
+
+    def _recv_exactly(self, conn, n):
+        buf = b''
+        while len(buf) < n:
+            s = conn.recv(n - len(buf))
+            if not s:
+                return None
+            buf += s
+        return buf
+
+    def _serve_tcp_conn(self, conn):
+        try:
+            while True:
+                length = self._recv_exactly(conn, 2)
+                if length is None:
+                    return
+                wire = self._recv_exactly(conn, struct.unpack(b'!H', length)[0])
+                if wire is None:
+                    return
+                response = self._respond(wire, True)
+                conn.sendall(struct.pack(b'!H', len(response)) + response)
+                if self.close_after_response:
+                    return
+        finally:
+            conn.close()
+
+class ResolverTestCase(unittest.TestCase):
+    responder_kwargs = {}
+
+    def setUp(self):
+        self.responder = Responder(**self.responder_kwargs)
+        self.tm = transport.DNSQueryTransportManager()
+        self.th_factory = transport.DNSQueryTransportHandlerDNSPrivateFactory(pool_tcp=True)
+
+    def tearDown(self):
+        self.tm.close()
+        self.responder.close()
+
+    def resolver(self, query_cls=query.StandardRecursiveQuery, **kwargs):
+        kwargs.setdefault('timeout', 0.5)
+        kwargs.setdefault('max_attempts', 2)
+        kwargs.setdefault('lifetime', 3.0)
+        return resolver.Resolver([SERVER], query_cls, port=self.responder.port, transport_manager=self.tm, th_factories=(self.th_factory,), **kwargs)
+
+    def num_queries(self, qname=None):
+        return len([x for x in self.responder.queries if qname is None or x[0] == _name(qname)])
+
+class CacheTestCase(ResolverTestCase):
+    def _ttl_left(self, cache, query_tuple):
+        return cache[query_tuple][0] - resolver.monotonic()
+
+    def test_positive_response_cached(self):
+        r = self.resolver()
+        a1 = r.query_for_answer(_name('www.example.'), A)
+        a2 = r.query_for_answer(_name('www.example.'), A)
+        self.assertEqual(a1.rrset, a2.rrset)
+        self.assertEqual(self.num_queries(), 1)
+        self.assertIn((_name('www.example.'), A, IN), r._pos_cache)
+
+    def test_cname_nodata_cached_as_negative(self):
+        r = self.resolver()
+        query_tuple = (_name('cnodata.example.'), A, IN)
+        self.assertRaises(dns.resolver.NoAnswer, r.query_for_answer, *query_tuple)
+        self.assertNotIn(query_tuple, r._pos_cache)
+        self.assertIn(query_tuple, r._neg_cache)
+        self.assertLessEqual(self._ttl_left(r._neg_cache, query_tuple), 60)
+
+        self.assertRaises(dns.resolver.NoAnswer, r.query_for_answer, *query_tuple)
+        self.assertEqual(self.num_queries(), 1)
+
+    def test_cname_nodata_without_soa_not_cached(self):
+        r = self.resolver()
+        for i in range(2):
+            self.assertRaises(dns.resolver.NoAnswer, r.query_for_answer, _name('cnodatanosoa.example.'), A)
+        self.assertEqual(self.num_queries(), 2)
+
+    def test_negative_ttl_capped(self):
+        r = self.resolver(cache_neg_max_ttl=30)
+        query_tuple = (_name('nx.example.'), A, IN)
+        self.assertRaises(dns.resolver.NXDOMAIN, r.query_for_answer, *query_tuple)
+        self.assertLessEqual(self._ttl_left(r._neg_cache, query_tuple), 30)
+
+    def test_positive_ttl_capped(self):
+        r = self.resolver(cache_max_ttl=10)
+        query_tuple = (_name('www.example.'), A, IN)
+        r.query_for_answer(*query_tuple)
+        self.assertLessEqual(self._ttl_left(r._pos_cache, query_tuple), 10)
+
+    def test_expiry(self):
+        r = self.resolver()
+        r.query_for_answer(_name('short.example.'), A)
+        time.sleep(1.1)
+        r.query_for_answer(_name('short.example.'), A)
+        self.assertEqual(self.num_queries(), 2)
+
+    def test_lru_eviction(self):
+        r = self.resolver(cache_size=2)
+        for qname in ('a.example.', 'b.example.', 'a.example.', 'c.example.'):
+            r.query_for_answer(_name(qname), A)
+        self.assertEqual(set([x[0] for x in r._pos_cache]), set([_name('a.example.'), _name('c.example.')]))
+        self.assertEqual(self.num_queries(), 3)
+
+    def test_cache_disabled(self):
+        r = self.resolver(cache_size=0)
+        for i in range(2):
+            r.query_for_answer(_name('www.example.'), A)
+        self.assertEqual(self.num_queries(), 2)
+
+    def test_flush_cache(self):
+        r = self.resolver()
+        r.query_for_answer(_name('www.example.'), A)
+        r.flush_cache()
+        r.query_for_answer(_name('www.example.'), A)
+        self.assertEqual(self.num_queries(), 2)
+
+class InFlightTestCase(ResolverTestCase):
+    responder_kwargs = { 'delay': 0.3 }
+
+    def test_concurrent_queries_coalesced(self):
+        r = self.resolver()
+        answers = []
+        def _query():
+            answers.append(r.query_for_answer(_name('www.example.'), A))
+        threads = [threading.Thread(target=_query) for i in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(answers), 5)
+        self.assertEqual(self.num_queries(), 1)
+        self.assertEqual(r._inflight, {})
+
+    def test_claims_released_on_exception(self):
+        r = self.resolver()
+        cache_get = r._cache_get
+        def _cache_get(query_tuple):
+            if query_tuple[0] == _name('b.example.'):
+                raise ValueError()
+            return cache_get(query_tuple)
+        r._cache_get = _cache_get
+        self.assertRaises(ValueError, r.query_multiple, (_name('a.example.'), A, IN), (_name('b.example.'), A, IN))
+        self.assertEqual(r._inflight, {})
+
+        r._cache_get = cache_get
+        responses = r.query_multiple((_name('a.example.'), A, IN), (_name('b.example.'), A, IN))
+        self.assertEqual(len(responses), 2)
+
+class TCPTestCase(ResolverTestCase):
+    def _query_tc(self, r, n):
+        for i in range(n):
+            server, response = r.query(_name('tc%d.example.' % i), A)
+            self.assertTrue(response.is_complete_response() and response.is_valid_response())
+            self.assertTrue(response.message.answer)
+            for retry in response.history:
+                self.assertNotEqual(retry.cause, query.RETRY_CAUSE_NETWORK_ERROR)
+
+    def test_connection_reused(self):
+        self._query_tc(self.resolver(cache_size=0), 3)
+        self.assertEqual(self.responder.tcp_connections, 1)
+
+    def test_connection_not_pooled_by_default(self):
+        self.th_factory = transport.DNSQueryTransportHandlerDNSPrivateFactory()
+        self._query_tc(self.resolver(cache_size=0), 3)
+        self.assertEqual(self.responder.tcp_connections, 3)
+        self.assertEqual(self.th_factory._tcp_pool, {})
+
+    def test_reconnect_after_server_close(self):
+        # the server closes each connection after responding, but the
+        # connection is re-used anyway, as if the close raced the check
+        self.responder.close_after_response = True
+        self.th_factory._is_idle_sock_usable = lambda sock: True
+        self._query_tc(self.resolver(cache_size=0), 3)
+        self.assertEqual(self.responder.tcp_connections, 3)
+
+@unittest.skipIf(resolver.lmdb is None, 'py-lmdb is not installed')
+class SharedCacheTestCase(ResolverTestCase):
+    def setUp(self):
+        super(SharedCacheTestCase, self).setUp()
+        self.cache_path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        resolver._close_shared_caches()
+        shutil.rmtree(self.cache_path)
+        super(SharedCacheTestCase, self).tearDown()
+
+    def test_round_trip(self):
+        a1 = self.resolver(cache_path=self.cache_path).query_for_answer(_name('www.example.'), A)
+        a2 = self.resolver(cache_path=self.cache_path).query_for_answer(_name('www.example.'), A)
+        self.assertEqual(a1.rrset, a2.rrset)
+        self.assertEqual(a2.server, SERVER)
+        self.assertEqual(self.num_queries(), 1)
+
+    def test_different_configuration_not_shared(self):
+        self.resolver(cache_path=self.cache_path).query_for_answer(_name('www.example.'), A)
+        self.resolver(query.RecursiveDNSSECQuery, cache_path=self.cache_path).query_for_answer(_name('www.example.'), A)
+        self.assertEqual(self.num_queries(), 2)
+
+    def test_corrupt_entry_ignored(self):
+        r = self.resolver(cache_path=self.cache_path)
+        query_tuple = (_name('www.example.'), A, IN)
+        key = r._shared_cache_key(query_tuple)
+        env = resolver._get_shared_cache(self.cache_path)
+        with env.begin(write=True) as txn:
+            txn.put(key, b'{"expiration": ')
+
+        self.assertIsNone(r._cache_get(query_tuple))
+        with env.begin() as txn:
+            self.assertIsNone(txn.get(key))
+
+    def test_flush_cache(self):
+        r = self.resolver(cache_path=self.cache_path)
+        r.query_for_answer(_name('www.example.'), A)
+        r.flush_cache()
+        self.resolver(cache_path=self.cache_path).query_for_answer(_name('www.example.'), A)
+        self.assertEqual(self.num_queries(), 2)
+
+if __name__ == '__main__':
+    unittest.main()